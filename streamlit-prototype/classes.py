@@ -1,29 +1,105 @@
+import collections
+import io
+import threading
 import streamlit as st
+import numpy as np
 import pandas as pd
-from datetime import datetime
-from sqlalchemy import create_engine, text
+from sqlalchemy import create_engine, event, text
 
 # --- HELPER: Database Connection ---
-@st.cache_resource
-def get_db_engine(user_key):
+def _get_db_info(user_key):
     # Dynamically fetch the secret based on user_key
     if user_key not in st.secrets["connections"]:
         st.error(f"User '{user_key}' not found in secrets.")
         st.stop()
         
-    db_info = st.secrets["connections"][user_key]
-    
+    return st.secrets["connections"][user_key]
+
+def _db_url(db_info):
     # Handle dictionary vs string format in secrets
     if "url" in db_info:
-        url = db_info["url"].replace("postgres://", "postgresql://")
-        return create_engine(url)
-    
-    return create_engine(f"postgresql+psycopg2://{db_info['username']}:{db_info['password']}@{db_info['host']}/{db_info['database']}")
+        return db_info["url"].replace("postgres://", "postgresql://")
+    return f"postgresql+psycopg2://{db_info['username']}:{db_info['password']}@{db_info['host']}/{db_info['database']}"
+
+@st.cache_resource
+def get_db_engine(user_key):
+    # Keep a small pool of warm connections; pre-ping and recycle drop ones Neon closed while idle
+    engine = create_engine(
+        _db_url(_get_db_info(user_key)), pool_size=5, max_overflow=5, pool_pre_ping=True, pool_recycle=300
+    )
+    event.listen(engine, "connect", _tune_session)
+    return engine
+
+def _read_connection(user_key):
+    """Pooled connection whose transactions run READ ONLY; the flag is reset when it returns to the pool."""
+    return get_db_engine(user_key).connect().execution_options(postgresql_readonly=True)
+
+def _tune_session(dbapi_conn, connection_record):
+    """Per-connection settings: lock waits give up after 5s instead of blocking indefinitely."""
+    with dbapi_conn.cursor() as cur:
+        cur.execute("SET lock_timeout TO '5s'")
+    dbapi_conn.commit()
+
+# --- HELPER: Schema Init ---
+# Runs a manager's init_db() once per table/user (and category set) instead of on every rerun.
+@st.cache_resource(show_spinner=False)
+def _init_db_once(_manager, table, user_key, categories=()):
+    _manager.init_db()
+
+# --- HELPER: Data Version ---
+# One counter per user for the whole process, bumped after every write so the cached reads
+# below are invalidated. It must not live in session_state: st.cache_data is shared by all sessions.
+@st.cache_resource
+def _data_versions():
+    return collections.defaultdict(int), threading.Lock()
+
+def get_data_version(user_key):
+    versions, lock = _data_versions()
+    with lock:
+        return versions[user_key]
+
+def bump_data_version(user_key):
+    versions, lock = _data_versions()
+    with lock:
+        versions[user_key] += 1
+
+@st.cache_data(show_spinner=False, max_entries=8)
+def _load_expenses(user_key, version):
+    # Server-side cursor streams rows in chunks instead of buffering the whole result client-side
+    with _read_connection(user_key).execution_options(stream_results=True) as conn:
+        chunks = pd.read_sql(text("SELECT * FROM expenses"), conn, parse_dates=["date"], chunksize=10_000)
+        return pd.concat(chunks, ignore_index=True)
+
+@st.cache_data(show_spinner=False, max_entries=32)
+def _load_expense_page(user_key, version, offset, limit):
+    with _read_connection(user_key) as conn:
+        return pd.read_sql(
+            text("SELECT * FROM expenses ORDER BY date DESC, id DESC LIMIT :n OFFSET :o"),
+            conn, params={"n": limit, "o": offset}, parse_dates=["date"]
+        )
+
+@st.cache_data(show_spinner=False, max_entries=32)
+def _load_balances(user_key, version):
+    with _read_connection(user_key) as conn:
+        result = conn.execute(text("SELECT category, current_balance FROM budgets"))
+        return {row[0]: row[1] for row in result.fetchall()}
+
+@st.cache_data(show_spinner=False, max_entries=32)
+def _load_category_totals(user_key, version):
+    with _read_connection(user_key) as conn:
+        df = pd.read_sql(text("SELECT category, SUM(amount) AS amount FROM expenses GROUP BY category"), conn)
+        return df.set_index("category")["amount"]
+
+@st.cache_data(show_spinner=False, max_entries=32)
+def _load_totals(user_key, version):
+    with _read_connection(user_key) as conn:
+        total, count = conn.execute(text("SELECT COALESCE(SUM(amount), 0), COUNT(*) FROM expenses")).one()
+        return total, count
 
 class ExpenseManager:
     def __init__(self, user_key):
         self.user_key = user_key
-        self.init_db()
+        _init_db_once(self, "expenses", user_key)
 
     def get_connection(self):
         return get_db_engine(self.user_key).connect()
@@ -40,21 +116,29 @@ class ExpenseManager:
                     amount REAL
                 )
             """))
+            conn.execute(text("CREATE INDEX IF NOT EXISTS idx_expenses_category ON expenses (category)"))
+            conn.execute(text("CREATE INDEX IF NOT EXISTS idx_expenses_date ON expenses (date)"))
             conn.commit()
 
     def load_data(self):
-        with self.get_connection() as conn:
-            try:
-                df = pd.read_sql(text("SELECT * FROM expenses"), conn, parse_dates=["date"])
-                return df
-            except Exception:
-                return pd.DataFrame(columns=["id", "date", "category", "description", "amount"])
+        """Whole expenses table. Kept as API; the dashboard only reads via load_page and the SQL aggregates."""
+        return _load_expenses(self.user_key, get_data_version(self.user_key))
+
+    def load_page(self, offset, limit):
+        """Newest-first slice of expenses, sorted and limited in SQL."""
+        return _load_expense_page(self.user_key, get_data_version(self.user_key), offset, limit)
+
+    def save_bulk_data(self, df: pd.DataFrame, replace_ids=None):
+            """Replaces the whole table with df, or only the rows in replace_ids (e.g. one editor page)."""
+            if replace_ids is None:
+                scope, params = "", {}
+            else:
+                scope, params = " WHERE id = ANY(:ids)", {"ids": [int(i) for i in replace_ids]}
 
-    def save_bulk_data(self, df: pd.DataFrame):
             with self.get_connection() as conn:
                 with conn.begin(): # Transaction
                     # 1. Calculate net change per category
-                    old_df = pd.read_sql(text("SELECT category, amount FROM expenses"), conn)
+                    old_df = pd.read_sql(text("SELECT category, amount FROM expenses" + scope), conn, params=params)
                     old_totals = old_df.groupby("category")["amount"].sum()
                     new_totals = df.groupby("category")["amount"].sum()
                     
@@ -63,8 +147,8 @@ class ExpenseManager:
                     diffs = new_totals.reindex(all_cats, fill_value=0) - old_totals.reindex(all_cats, fill_value=0)
 
                     # 2. Sync Expenses table
-                    conn.execute(text("DELETE FROM expenses"))
-                    df.to_sql("expenses", conn, if_exists="append", index=False)
+                    conn.execute(text("DELETE FROM expenses" + scope), params)
+                    self._copy_expenses(conn, df)
 
                     # 3. Adjust Budgets (Difference is subtracted because Expense up = Balance down)
                     for cat, diff in diffs.items():
@@ -73,43 +157,69 @@ class ExpenseManager:
                                 text("UPDATE budgets SET current_balance = current_balance - :d WHERE category = :c"),
                                 {"d": float(diff), "c": cat}
                             )
+            bump_data_version(self.user_key)
+
+    @staticmethod
+    def _copy_expenses(conn, df):
+        """Bulk-loads df into expenses with COPY on the connection's open transaction.
+
+        Rows without an id (added in the editor) are loaded without the id column so the sequence assigns one.
+        """
+        if df.empty: return
+        if "id" in df.columns:
+            is_new = df["id"].isna()
+            # Edited frames hold ids as floats; COPY needs integer text
+            existing = df[~is_new].astype({"id": "Int64"})
+            added = df[is_new].drop(columns="id")
+        else:
+            existing, added = df.iloc[0:0], df
+
+        with conn.connection.cursor() as cur:
+            ExpenseManager._copy_rows(cur, existing)
+            ExpenseManager._copy_rows(cur, added)
+
+    @staticmethod
+    def _copy_rows(cur, df):
+        if df.empty: return
+        # Missing values go out as \N so empty-string descriptions stay '' instead of becoming NULL
+        buffer = io.StringIO()
+        df.to_csv(buffer, index=False, header=False, na_rep="\\N")
+        buffer.seek(0)
+        cur.copy_expert(f"COPY expenses ({', '.join(df.columns)}) FROM STDIN WITH (FORMAT csv, NULL '\\N')", buffer)
 
     def add_expense(self, category, description, amount):
         with self.get_connection() as conn:
             with conn.begin(): # Transaction block
                 # 1. Record the Transaction
                 conn.execute(
-                    text("INSERT INTO expenses (date, category, description, amount) VALUES (:d, :c, :desc, :a)"),
-                    {"d": datetime.now(), "c": category, "desc": description, "a": amount}
-                )         
+                    text("INSERT INTO expenses (category, description, amount) VALUES (:c, :desc, :a)"),
+                    {"c": category, "desc": description, "a": amount}
+                )
                 # 2. Deduct from the Budget Bucket
                 conn.execute(
                     text("UPDATE budgets SET current_balance = current_balance - :a WHERE category = :c"),
                     {"a": amount, "c": category}
                 )
-        return self.load_data()
+        bump_data_version(self.user_key)
 
-    @staticmethod
-    def calculate_metrics(df):
-        if df.empty: return 0, 0
-        return df["amount"].sum(), len(df)
+    def totals(self):
+        """Total spent and number of transactions, aggregated in SQL."""
+        return _load_totals(self.user_key, get_data_version(self.user_key))
 
-    @staticmethod
-    def get_expenses_by_category(df):
-        if df.empty: return pd.Series()
-        return df.groupby("category")["amount"].sum()
+    def category_totals(self):
+        """Amount spent per category, aggregated in SQL."""
+        return _load_category_totals(self.user_key, get_data_version(self.user_key))
 
     @staticmethod
     def get_category_matrix(df, categories):
-        data_dict = {}
-        max_len = 0
-        for cat in categories:
-            amounts = df[df["category"] == cat]["amount"].tolist()
-            data_dict[cat] = amounts
-            max_len = max(max_len, len(amounts))
-        for cat in data_dict:
-            data_dict[cat] += [None] * (max_len - len(data_dict[cat]))
-        return pd.DataFrame(data_dict)
+        # Row n holds the n-th expense of each category; shorter columns are NaN-padded by the pivot
+        df = df[df["category"].isin(categories)]
+        matrix = (
+            df.assign(_i=df.groupby("category").cumcount())
+            .pivot(index="_i", columns="category", values="amount")
+            .reindex(columns=categories)
+        )
+        return matrix.rename_axis(index=None, columns=None).reset_index(drop=True)
 
 
 class BudgetManager:
@@ -117,7 +227,15 @@ class BudgetManager:
         self.user_key = user_key
         self.allocation_map = allocation_map 
         self.limit_map = limit_map
-        self.init_db()
+        # Loop-invariant (category, pct, limit) rows for the waterfall; zero-share categories never receive income
+        self._positive_cats = tuple(
+            (cat, pct, limit_map.get(cat, 0)) for cat, pct in allocation_map.items() if pct > 0
+        )
+        # Same rows as fixed-index arrays (a limit of 0 means uncapped)
+        self._cat_index = {cat: i for i, (cat, _, _) in enumerate(self._positive_cats)}
+        self._weights = np.array([pct for _, pct, _ in self._positive_cats], dtype=float)
+        self._limits = np.array([limit or np.inf for _, _, limit in self._positive_cats], dtype=float)
+        _init_db_once(self, "budgets", user_key, tuple(allocation_map))
 
     def get_connection(self):
         return get_db_engine(self.user_key).connect()
@@ -134,66 +252,73 @@ class BudgetManager:
                 
                 with conn.begin():
                     config_categories = list(self.allocation_map.keys())
-                    # 1. Add new categories from config
-                    for cat in config_categories:
+                    # 1. Add new categories from config (one batched statement)
+                    if config_categories:
                         conn.execute(
                             text("INSERT INTO budgets (category, current_balance) VALUES (:cat, 0) ON CONFLICT (category) DO NOTHING"),
-                            {"cat": cat}
+                            [{"cat": cat} for cat in config_categories]
                         )
                     # 2. Remove categories from DB that are no longer in config
-                    conn.execute(
-                        text("DELETE FROM budgets WHERE category NOT IN :cats"),
-                        {"cats": tuple(config_categories)}
-                    )
+                    if config_categories:
+                        conn.execute(
+                            text("DELETE FROM budgets WHERE category NOT IN :cats"),
+                            {"cats": tuple(config_categories)}
+                        )
+                    else:
+                        conn.execute(text("DELETE FROM budgets"))
 
     def get_balances(self):
-        with self.get_connection() as conn:
-            result = conn.execute(text("SELECT category, current_balance FROM budgets"))
-            rows = result.fetchall()
-            return {row[0]: row[1] for row in rows}
+        return _load_balances(self.user_key, get_data_version(self.user_key))
 
     def allocate_income(self, income_amount):
         """Distributes income with waterfall logic."""
-        current_balances = self.get_balances()
-        allocations = {cat: 0.0 for cat in self.allocation_map}
-        remaining_income = float(income_amount)
-        
-        # --- Waterfall Logic ---
-        while remaining_income > 0.01:
-            active_cats = []
-            for cat, pct in self.allocation_map.items():
-                if pct <= 0: continue
-                limit = self.limit_map.get(cat, 0)
-                current = current_balances.get(cat, 0.0) + allocations[cat]
-                if limit == 0 or current < limit:
-                    active_cats.append(cat)
-
-            if not active_cats: break 
-
-            total_active_weight = sum(self.allocation_map[c] for c in active_cats)
-            if total_active_weight == 0: break
-
-            distributed_this_round = 0
-            for cat in active_cats:
-                weight = self.allocation_map[cat] / total_active_weight
-                share = remaining_income * weight
-                limit = self.limit_map.get(cat, 0)
-                current = current_balances.get(cat, 0.0) + allocations[cat]
-                space = (limit - current) if limit > 0 else float('inf')
-                actual_add = min(share, space)
-                allocations[cat] += actual_add
-                distributed_this_round += actual_add
-
-            remaining_income -= distributed_this_round
-            if distributed_this_round < 0.01: break
-
         with self.get_connection() as conn:
             with conn.begin():
-                for cat, amount in allocations.items():
-                    if amount > 0:
-                        conn.execute(
-                            text("UPDATE budgets SET current_balance = current_balance + :amt WHERE category = :cat"),
-                            {"amt": amount, "cat": cat}
-                        )
-        
+                # Lock the budget rows up front so concurrent writes can't move balances mid-waterfall.
+                # Category order matches save_bulk_data's sorted updates, so the two can't deadlock.
+                result = conn.execute(text("SELECT category, current_balance FROM budgets ORDER BY category FOR UPDATE"))
+                current_balances = {row[0]: row[1] for row in result.fetchall()}
+                allocations = self._waterfall(current_balances, income_amount)
+
+                params = [{"amt": amount, "cat": cat} for cat, amount in allocations.items() if amount > 0]
+                if params:
+                    conn.execute(
+                        text("UPDATE budgets SET current_balance = current_balance + :amt WHERE category = :cat"),
+                        params
+                    )
+        bump_data_version(self.user_key)
+
+        return allocations
+
+    def _waterfall(self, current_balances, income_amount):
+        """Splits income by allocation_map, capping each category at its limit and redistributing the overflow."""
+        balances = np.array([current_balances.get(cat, 0.0) for cat in self._cat_index], dtype=float)
+        income = float(income_amount)
+
+        # --- Waterfall Logic ---
+        # Closed-form water-filling: every category gets weight * level, capped at its space.
+        # Sorting by the level at which each one caps lets a cumsum find the level that absorbs the income.
+        space = self._limits - balances
+        active = space > 0
+        weights, caps = self._weights[active], space[active]
+
+        cap_levels = caps / weights
+        order = np.argsort(cap_levels)
+        sorted_levels, sorted_weights, sorted_caps = cap_levels[order], weights[order], caps[order]
+        capped_before = np.concatenate(([0.0], np.cumsum(sorted_caps)[:-1]))
+        weight_from = np.cumsum(sorted_weights[::-1])[::-1]
+        absorbed = capped_before + sorted_levels * weight_from  # income used up when the level reaches each cap
+
+        k = np.searchsorted(absorbed, income)
+        if k == len(absorbed):
+            level = np.inf  # Every category fills; the leftover stays unallocated
+        else:
+            level = max((income - capped_before[k]) / weight_from[k], 0.0)
+
+        added = np.zeros_like(balances)
+        added[active] = np.minimum(weights * level, caps)
+
+        allocations = {cat: 0.0 for cat in self.allocation_map}
+        for cat, i in self._cat_index.items():
+            allocations[cat] = float(added[i])
         return allocations
\ No newline at end of file
@@ -1,3 +1,4 @@
+import math
 import streamlit as st
 from classes import ExpenseManager, BudgetManager
 
@@ -22,14 +23,13 @@ user_data = get_user_config_from_secrets(user_key)
 CATEGORIES = list(user_data["CATEGORY_CONFIG"].keys())
 ALLOCATION_PCT = dict(user_data["ALLOCATION_PCT"])
 CATEGORY_CONFIG = dict(user_data["CATEGORY_CONFIG"])
+CATEGORY_ITEMS = tuple(CATEGORY_CONFIG.items())  # (category, limit) pairs in display order
+PAGE_SIZE = 50  # Rows per Transactions Editor page
 
 # 3. Instantiate Managers
 expense_manager = ExpenseManager(user_key=user_key) 
 budget_manager = BudgetManager(ALLOCATION_PCT, CATEGORY_CONFIG, user_key=user_key)
 
-if 'df' not in st.session_state:
-    st.session_state.df = expense_manager.load_data()
-
 # --- Sidebar: Add New Expense ---
 with st.sidebar:
     st.header("Add New Expense")
@@ -41,7 +41,7 @@ with st.sidebar:
         submitted = st.form_submit_button("Add Expense")
         
         if submitted:
-            st.session_state.df = expense_manager.add_expense(category, description, amount)
+            expense_manager.add_expense(category, description, amount)
             st.toast("Expense added!")
      
     st.markdown("---")
@@ -62,21 +62,22 @@ with st.sidebar:
                         st.write(f"**{cat}**: +${amt:,.0f}")
 
 # --- Main Page: Dashboard ---
-if st.session_state.df.empty:
+total_spent, total_count = expense_manager.totals()
+
+if total_count == 0:
     st.info("Start by adding expenses in the sidebar!")
 else:
     # 1. Metrics Row
-    total_spent, total_count = ExpenseManager.calculate_metrics(st.session_state.df)
     col1, col2 = st.columns(2)
     col1.metric("Total Spent", f"${total_spent:,.0f}")
-    col2.metric("Total Transactions", len(st.session_state.df))
+    col2.metric("Total Transactions", total_count)
     st.markdown("---")
     st.subheader("Budgets")
     
     balances = budget_manager.get_balances()
     cols = st.columns(3) 
     
-    for i, (category, limit) in enumerate(CATEGORY_CONFIG.items()):
+    for i, (category, limit) in enumerate(CATEGORY_ITEMS):
             current = balances.get(category, 0.0)
             
             with cols[i % 3]: 
@@ -97,14 +98,15 @@ else:
     # 2. Charts
     st.subheader("Expenses by Category")
     # Grouping by category for visual
-    if not st.session_state.df.empty:
-        chart_data = ExpenseManager.get_expenses_by_category(st.session_state.df)
-        st.bar_chart(chart_data)
+    chart_data = expense_manager.category_totals()
+    st.bar_chart(chart_data)
 
     # 3. Data Table (Editable)
     st.subheader("Transactions Editor")
     
-    df_display = st.session_state.df.sort_values(by="date", ascending=False)
+    page_count = max(1, math.ceil(total_count / PAGE_SIZE))
+    page = st.number_input("Page", min_value=1, max_value=page_count, value=1, step=1)
+    df_display = expense_manager.load_page((page - 1) * PAGE_SIZE, PAGE_SIZE)
     
     edited_df = st.data_editor(
         df_display,
@@ -118,11 +120,11 @@ else:
             "category": st.column_config.TextColumn(label="Category"),
             "description": st.column_config.TextColumn(label="Description")
         },
-        key="main_editor"
+        key=f"main_editor_{page}"
     )
 
     if st.button("Save Changes to DB"):
-        st.session_state.df = edited_df
-        expense_manager.save_bulk_data(edited_df)
+        # Only the rows shown on this page are replaced
+        expense_manager.save_bulk_data(edited_df, replace_ids=df_display["id"].tolist())
         st.success("Database updated successfully!")
         st.rerun()